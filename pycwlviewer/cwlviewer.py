@@ -1,16 +1,103 @@
 #!/usr/bin/env python
+import codecs
+import functools
+import hashlib
+import json
 import logging
+import re
+import tempfile
 from pathlib import Path
-from io import StringIO, BytesIO
-from typing import List, Optional, Union
+from typing import BinaryIO, Callable, Dict, List, Optional, Set, Tuple, Union
 import sys
 
-import rdflib
-import pygraphviz as pgv
-from urllib.parse import urlparse
-from cwltool.main import main as cwltool_main
 import os
 
+from pycwlviewer import __version__
+
+_queries_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'queries')
+_QUERIES: Dict[str, str] = {
+    query_file.name: query_file.read_text()
+    for query_file in Path(_queries_dir).iterdir() if query_file.suffix == '.sparql'
+}
+
+
+_CACHE_FORMAT = 1
+
+_logger = logging.getLogger(__name__)
+
+
+def _cache_dir() -> Path:
+    """The per-user directory of the on-disk cache, under XDG_CACHE_HOME or ~/.cache."""
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'pycwlviewer'
+
+
+def _loaded_files(loader) -> Dict[str, int]:
+    """The mtime of every local file cwltool loaded, the workflow and the run files of its steps."""
+    from schema_salad.ref_resolver import uri_file_path
+    paths = (uri_file_path(uri) for uri in loader.idx if uri.startswith('file://') and '#' not in uri)
+    return {path: os.stat(path).st_mtime_ns for path in paths if os.path.isfile(path)}
+
+
+def _open_cache(cache_path: Path) -> Optional[BinaryIO]:
+    """
+    Open the cache file past its header line, or return None when it is missing, unreadable,
+    written by another version of the cache or when any of the files it was built from changed.
+    """
+    try:
+        cache_file = open(str(cache_path), 'rb')
+    except OSError:
+        return None
+    try:
+        header = json.loads(cache_file.readline().decode('utf-8').lstrip('#'))
+        if header['format'] == [__version__, _CACHE_FORMAT] and all(
+                os.stat(path).st_mtime_ns == mtime_ns for path, mtime_ns in header['files'].items()):
+            return cache_file
+    except (OSError, ValueError, LookupError, TypeError, AttributeError):
+        pass
+    cache_file.close()
+    return None
+
+
+def _write_cache(cache_path: Path, files: Dict[str, int], write: Callable[[BinaryIO], None]):
+    """
+    Write the header line and let `write` stream the data to a temporary file moved in place,
+    so a concurrent reader never sees a partial cache. The cache is only an optimization,
+    failing to write it is logged.
+    """
+    try:
+        cache_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(cache_path.parent), prefix=f'{cache_path.name}.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                header = {'format': [__version__, _CACHE_FORMAT], 'files': files}
+                f.write(f"#{json.dumps(header)}\n".encode('utf-8'))
+                write(f)
+            os.replace(tmp_path, str(cache_path))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        _logger.warning('could not write the cache %s: %s', cache_path, e)
+
+
+def _frag(uri) -> str:
+    """Return the fragment of the URI, the part after the last `#`."""
+    return str(uri).rpartition('#')[2]
+
+
+def _dot_id(value: str) -> str:
+    """
+    Quote a string as a DOT ID. The DOT parser only unescapes `\\"`, so only the backslashes
+    that would escape a quote or the closing quote are doubled, the rest keep their graphviz
+    meaning (e.g. `\\n` in labels).
+    """
+    value = re.sub(r'\\+(?="|\Z)', lambda backslashes: backslashes.group(0) * 2, value)
+    return '"' + value.replace('"', '\\"') + '"'
+
+
+def _dot_attrs(attrs: Dict[str, str]) -> str:
+    return '[' + ', '.join(f'{key}={_dot_id(value)}' for key, value in attrs.items()) + ']'
+
 
 class CWLViewer:
     """
@@ -18,131 +105,281 @@ class CWLViewer:
     https://github.com/common-workflow-language/cwlviewer.
     """
 
-    _queries_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'queries')
-    _get_inner_edges_query_path = os.path.join(_queries_dir, 'get_inner_edges.sparql')
-    _get_input_edges_query_path = os.path.join(_queries_dir, 'get_input_edges.sparql')
-    _get_output_edges_query_path = os.path.join(_queries_dir, 'get_output_edges.sparql')
-    _get_root_query_path = os.path.join(_queries_dir, 'get_root.sparql')
+    _edges_query = None
+    _root_query = None
+
+    # the static parts of the DOT text, the nodes and edges are filled in per workflow
+    _dot_header = (
+        'digraph {\n'
+        'graph [bgcolor="#eeeeee", clusterrank=local, '
+        "label=<<font color='#AAAAAA'>Produced by PyCWLViewer</font>>, labelloc=bottom, labeljust=right];\n"
+        'node [label="\\N", shape=record];'
+    )
+    _inputs_cluster_header = (
+        'subgraph cluster_inputs {\n'
+        'graph [rank=same, style=dashed, label="Workflow Inputs"];'
+    )
+    _outputs_cluster_header = (
+        'subgraph cluster_outputs {\n'
+        'graph [rank=same, style=dashed, label="Workflow Outputs", labelloc=b];'
+    )
+    _step_node_attrs = {'fillcolor': 'lightgoldenrodyellow', 'style': "filled"}
+    _io_node_attrs = {'fillcolor': "#94DDF4", 'style': "filled"}
 
-    def __init__(self, filename: Path):
+    def __init__(self, filename: Path, use_rdflib: bool = False):
+        """
+        :param filename: the CWL workflow
+        :param use_rdflib: extract the workflow structure with SPARQL queries over the RDF
+            graph of the workflow, instead of reading it from the loaded document
+        """
         self._filename = filename
-        self._dot_graph: pgv.agraph.AGraph = CWLViewer._init_dot_graph()
-        self._rdf_graph: rdflib.graph.Graph = self._load_cwl_graph()
-        self._root_graph_uri: str = self.get_root_graph_uri()
-        self._set_inner_edges()
-        self._set_input_edges()
-        self._set_output_edges()
-
-    def _cwl2rdf(self) -> str:
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        stdout = StringIO()
-        cwltool_main(['--print-rdf', str(self._filename)], stdout=stdout, logger_handler=console_handler)
-        return stdout.getvalue()
-
-    def _load_cwl_graph(self) -> rdflib.graph.Graph:
-        rdf_graph = rdflib.Graph()
-        rdf_graph.parse(data=self._cwl2rdf(), format='n3')
+        self._nodes: Dict[str, Dict[str, str]] = {}
+        self._edges: List[Tuple[str, str]] = []
+        self._input_nodes: Set[str] = set()
+        self._output_nodes: Set[str] = set()
+        if use_rdflib:
+            CWLViewer._load_queries()
+            self._rdf_graph: "rdflib.Graph" = self._load_cwl_graph()
+            self._root_graph_uri: "rdflib.URIRef" = self._query_root_graph_uri()
+            self._set_edges()
+        else:
+            self._extract_workflow_structure()
+        self._dot_graph: "pygraphviz.AGraph" = self._build_dot_graph()
+        # the graphviz program the graph was last laid out with
+        self._laid_out: Optional[str] = None
+
+    def _load_tool(self) -> Tuple["cwltool.process.Process", "cwltool.context.LoadingContext"]:
+        from cwltool.context import LoadingContext
+        from cwltool.load_tool import fetch_document, make_tool, resolve_and_validate_document
+        from cwltool.resolver import tool_resolver
+        from cwltool.workflow import default_make_tool
+        loading_context = LoadingContext()
+        loading_context.construct_tool_object = default_make_tool
+        loading_context.resolver = tool_resolver
+        loading_context, workflowobj, uri = fetch_document(str(self._filename), loading_context)
+        loading_context, uri = resolve_and_validate_document(loading_context, workflowobj, uri)
+        return make_tool(uri, loading_context), loading_context
+
+    def _cwltool_cache_path(self, suffix: str) -> Optional[Path]:
+        """
+        The file caching what cwltool produced for the workflow, one per workflow path and suffix
+        in the per-user cache directory, checked against the mtime of every file cwltool loaded.
+        Caching is opt-in with PYCWLVIEWER_CWLTOOL_CACHE=1, None is returned otherwise.
+        """
+        if os.environ.get('PYCWLVIEWER_CWLTOOL_CACHE') != '1':
+            return None
+        digest = hashlib.sha1(str(Path(self._filename).resolve()).encode()).hexdigest()
+        return _cache_dir() / f"{digest}{suffix}"
+
+    def _load_cwl_graph(self) -> "rdflib.Graph":
+        """
+        Build the RDF graph of the workflow in-process, the same graph `cwltool --print-rdf`
+        would serialize, without the text round-trip.
+        """
+        import rdflib
+        from cwltool.cwlrdf import gather
+        cache_path = self._cwltool_cache_path('.nt')
+        cache_file = _open_cache(cache_path) if cache_path is not None else None
+        if cache_file is not None:
+            rdf_graph = rdflib.Graph()
+            with cache_file:
+                rdf_graph.parse(source=cache_file, format='nt')
+            return rdf_graph
+        tool, loading_context = self._load_tool()
+        rdf_graph = gather(tool, loading_context.loader.ctx)
+        if cache_path is not None:
+            _write_cache(cache_path, _loaded_files(loading_context.loader),
+                         lambda f: rdf_graph.serialize(destination=f, format='nt', encoding='utf-8'))
         return rdf_graph
 
-    def _set_inner_edges(self):
-        with open(self._get_inner_edges_query_path) as f:
-            get_inner_edges_query = f.read()
-        inner_edges = self._rdf_graph.query(get_inner_edges_query, initBindings={'root_graph': self._root_graph_uri})
-        for inner_edge_row in inner_edges:
-            source_label = inner_edge_row['source_label'] \
-                if inner_edge_row['source_label'] is not None \
-                else urlparse(inner_edge_row['source_step']).fragment
-            self._dot_graph.add_node(
-                inner_edge_row['source_step'],
-                fillcolor='lightgoldenrodyellow', style="filled",
-                label=source_label
-            )
-            target_label = inner_edge_row['target_label'] \
-                if inner_edge_row['target_label'] is not None \
-                else urlparse(inner_edge_row['target_step']).fragment
-            self._dot_graph.add_node(
-                inner_edge_row['target_step'],
-                fillcolor='lightgoldenrodyellow', style="filled",
-                label=target_label,
-            )
-            self._dot_graph.add_edge(inner_edge_row['source_step'], inner_edge_row['target_step'])
-
-    def _set_input_edges(self):
-        with open(self._get_input_edges_query_path) as f:
-            get_input_edges_query = f.read()
-        inputs_subgraph = self._dot_graph.add_subgraph(name="cluster_inputs")
-        inputs_subgraph.graph_attr['rank'] = "same"
-        inputs_subgraph.graph_attr['style'] = "dashed"
-        inputs_subgraph.graph_attr['label'] = "Workflow Inputs"
-        input_edges = self._rdf_graph.query(get_input_edges_query, initBindings={'root_graph': self._root_graph_uri})
-        for input_row in input_edges:
-            inputs_subgraph.add_node(
-                input_row['input'],
-                fillcolor="#94DDF4",
-                style="filled",
-                label=urlparse(input_row['input']).fragment,
-            )
-            self._dot_graph.add_edge(input_row['input'], input_row['step'])
-
-    def _set_output_edges(self):
-        with open(self._get_output_edges_query_path) as f:
-            get_output_edges = f.read()
-
-        outputs_graph = self._dot_graph.add_subgraph(name="cluster_outputs")
-        outputs_graph.graph_attr['rank'] = "same"
-        outputs_graph.graph_attr['style'] = "dashed"
-        outputs_graph.graph_attr['label'] = "Workflow Outputs"
-        outputs_graph.graph_attr['labelloc'] = "b"
-        output_edges = self._rdf_graph.query(get_output_edges, initBindings={'root_graph': self._root_graph_uri})
-        for output_edge_row in output_edges:
-            outputs_graph.add_node(
-                output_edge_row['output'],
-                fillcolor="#94DDF4",
-                style="filled",
-                label=urlparse(output_edge_row['output']).fragment,
-            )
-            self._dot_graph.add_edge(output_edge_row['step'], output_edge_row['output'])
+    def _extract_workflow_structure(self):
+        """
+        Collect the same nodes and edges as the SPARQL queries straight from the document
+        loaded by cwltool. The root workflow is the loaded process itself, like the root query
+        it has to have steps. A source repeated in a port is one RDF triple, so it is one edge.
+        The steps are taken in id order, cwltool does not load them in a stable one.
+        """
+        import rdflib
+        from cwltool.utils import aslist
+        from cwltool.workflow import Workflow
+        cache_path = self._cwltool_cache_path('.json')
+        cache_file = _open_cache(cache_path) if cache_path is not None else None
+        if cache_file is not None:
+            with cache_file:
+                structure = json.load(cache_file)
+            self._root_graph_uri = rdflib.URIRef(structure['root'])
+            self._nodes = structure['nodes']
+            self._edges = [tuple(edge) for edge in structure['edges']]
+            self._input_nodes = set(structure['inputs'])
+            self._output_nodes = set(structure['outputs'])
+            return
+        tool, loading_context = self._load_tool()
+        if not isinstance(tool, Workflow) or not tool.steps:
+            raise ValueError(f"no cwl:Workflow root found in {self._filename}")
+        self._root_graph_uri = rdflib.URIRef(tool.tool['id'])
+        steps = sorted(tool.steps, key=lambda step: step.id)
+        step_of_output = {}
+        for step in steps:
+            for step_output in step.tool['out']:
+                step_of_output[step_output if isinstance(step_output, str) else step_output['id']] = step
 
-    def get_root_graph_uri(self):
-        with open(self._get_root_query_path) as f:
-            get_root_query = f.read()
-        root = list(self._rdf_graph.query(get_root_query, ))[0]
-        return root['workflow']
+        for step in steps:
+            for port in step.tool['in']:
+                for source in dict.fromkeys(aslist(port.get('source', []))):
+                    if source in step_of_output:
+                        source_step = step_of_output[source]
+                        self._add_step_node(source_step.id, source_step.embedded_tool.tool.get('label'))
+                        self._add_step_node(step.id, step.embedded_tool.tool.get('label'))
+                        self._edges.append((source_step.id, step.id))
+        workflow_inputs = {workflow_input['id'] for workflow_input in tool.tool['inputs']}
+        for step in steps:
+            for port in step.tool['in']:
+                for source in dict.fromkeys(aslist(port.get('source', []))):
+                    if source in workflow_inputs:
+                        self._add_input_node(source)
+                        self._edges.append((source, step.id))
+        for workflow_output in tool.tool['outputs']:
+            for source in dict.fromkeys(aslist(workflow_output.get('outputSource', []))):
+                if source in step_of_output:
+                    self._add_output_node(workflow_output['id'])
+                    self._edges.append((step_of_output[source].id, workflow_output['id']))
+        if cache_path is not None:
+            structure = {
+                'root': str(self._root_graph_uri),
+                'nodes': self._nodes,
+                'edges': self._edges,
+                'inputs': sorted(self._input_nodes),
+                'outputs': sorted(self._output_nodes),
+            }
+            _write_cache(cache_path, _loaded_files(loading_context.loader),
+                         lambda f: json.dump(structure, codecs.getwriter('utf-8')(f)))
 
     @classmethod
-    def _init_dot_graph(cls) -> pgv.agraph.AGraph:
-        graph = pgv.AGraph(directed=True, strict=False)
-        graph.graph_attr['bgcolor'] = "#eeeeee"
-        graph.graph_attr['labeljust'] = "left"
-        graph.graph_attr['clusterrank'] = "local"
-        graph.node_attr['shape'] = "record"
-        graph.graph_attr['label'] = "<<font color='#AAAAAA'>Produced by PyCWLViewer</font>>"
-        graph.graph_attr['labelloc'] = "bottom"
-        graph.graph_attr['labeljust'] = "right"
-
-        return graph
-
-    def draw(self, filename: Union[Path, BytesIO], graphviz_layout: str = 'dot'):
-        self._dot_graph.layout(prog=graphviz_layout)
-        if isinstance(filename, Path):
-            self._dot_graph.draw(str(filename))
+    def _load_queries(cls):
+        """Parse the SPARQL queries once, they are shared by all the viewers."""
+        from rdflib.plugins.sparql import prepareQuery
+        if cls._edges_query is not None:
+            return
+        cls._edges_query = prepareQuery(_QUERIES['get_all_edges.sparql'])
+        cls._root_query = prepareQuery(_QUERIES['get_root.sparql'])
+
+    def _set_edges(self):
+        edges = self._rdf_graph.query(
+            CWLViewer._edges_query,
+            initBindings={'root_graph': self._root_graph_uri}
+        )
+        for edge_row in edges:
+            kind = str(edge_row['kind'])
+            source, target = str(edge_row['source']), str(edge_row['target'])
+            if kind == 'inner':
+                self._add_step_node(source, edge_row['source_label'])
+                self._add_step_node(target, edge_row['target_label'])
+            elif kind == 'input':
+                self._add_input_node(source)
+            elif kind == 'output':
+                self._add_output_node(target)
+            self._edges.append((source, target))
+
+    # self._nodes doubles as the seen-set, a step feeding k steps shows up in k edges
+    def _add_step_node(self, uri: str, label=None):
+        if uri not in self._nodes:
+            self._nodes[uri] = dict(self._step_node_attrs, label=str(label) if label is not None else _frag(uri))
+
+    def _add_input_node(self, uri: str):
+        if uri not in self._nodes:
+            self._nodes[uri] = dict(self._io_node_attrs, label=_frag(uri))
+            self._input_nodes.add(uri)
+
+    def _add_output_node(self, uri: str):
+        if uri not in self._nodes:
+            self._nodes[uri] = dict(self._io_node_attrs, label=_frag(uri))
+            self._output_nodes.add(uri)
+
+    def _build_dot_graph(self) -> "pygraphviz.AGraph":
+        """Render the collected nodes and edges as DOT text and parse it with a single call."""
+        import pygraphviz as pgv
+        lines = [self._dot_header]
+        for header, members in (
+                (self._inputs_cluster_header, self._input_nodes),
+                (self._outputs_cluster_header, self._output_nodes),
+        ):
+            lines.append(header)
+            lines.extend(
+                f'{_dot_id(node)} {_dot_attrs(node_attrs)};'
+                for node, node_attrs in self._nodes.items() if node in members
+            )
+            lines.append('}')
+        lines.extend(
+            f'{_dot_id(node)} {_dot_attrs(node_attrs)};'
+            for node, node_attrs in self._nodes.items()
+            if node not in self._input_nodes and node not in self._output_nodes
+        )
+        lines.extend(f'{_dot_id(source)} -> {_dot_id(target)};' for source, target in self._edges)
+        lines.append('}')
+        return pgv.AGraph(string='\n'.join(lines))
+
+    def get_root_graph_uri(self) -> "rdflib.URIRef":
+        return self._root_graph_uri
+
+    def _query_root_graph_uri(self) -> "rdflib.URIRef":
+        import rdflib
+        try:
+            root = next(iter(self._rdf_graph.query(CWLViewer._root_query)))
+        except StopIteration:
+            raise ValueError(f"no cwl:Workflow root found in {self._filename}") from None
+        return rdflib.URIRef(root['workflow'])
+
+    def _layout(self, graphviz_layout: str):
+        if self._laid_out != graphviz_layout:
+            self._dot_graph.layout(prog=graphviz_layout)
+            self._laid_out = graphviz_layout
+
+    def draw_bytes(self, fmt: str = 'png', prog: str = 'dot') -> bytes:
+        """Render the graph in the given format and return the image."""
+        self._layout(prog)
+        # without a path pygraphviz returns the rendered image
+        return self._dot_graph.draw(format=fmt)
+
+    def draw(self, filename: Union[str, "os.PathLike[str]", BinaryIO], graphviz_layout: str = 'dot'):
+        if isinstance(filename, (str, os.PathLike)):
+            path = Path(filename)
+            path.write_bytes(self.draw_bytes(fmt=path.suffix[1:].lower() or 'png', prog=graphviz_layout))
+        elif hasattr(filename, 'write'):
+            filename.write(self.draw_bytes(prog=graphviz_layout))
         else:
-            self._dot_graph.draw(filename, "png")
+            raise TypeError(f"cannot draw to {type(filename).__name__}, expected a path or a binary file")
 
     def dot(self):
         return self._dot_graph.to_string()
 
 
+@functools.lru_cache(maxsize=32)
+def _cached_workflow_dot(path: str, mtime_ns: int, size: int) -> str:
+    return CWLViewer(Path(path)).dot()
+
+
+def _workflow_dot(workflow: Path) -> str:
+    """
+    Return the DOT of the workflow. The result is cached by the workflow's path, mtime and size
+    unless PYCWLVIEWER_CACHE=0. Only the given file is checked, edits to the files of its steps
+    are not noticed until the workflow itself changes.
+    """
+    if os.environ.get('PYCWLVIEWER_CACHE', '1') == '0':
+        return CWLViewer(workflow).dot()
+    stat = os.stat(workflow)
+    return _cached_workflow_dot(str(Path(workflow).resolve()), stat.st_mtime_ns, stat.st_size)
+
+
 def view(workflow: Path, output: Path):
-    viewer = CWLViewer(workflow)
-    viewer.draw(output)
+    import pygraphviz as pgv
+    dot_graph = pgv.AGraph(string=_workflow_dot(workflow))
+    dot_graph.layout(prog='dot')
+    dot_graph.draw(str(output))
     print(f'Image {str(output)} created')
 
 
 def dot(workflow: Path):
-    viewer = CWLViewer(workflow)
-    print(viewer.dot())
+    print(_workflow_dot(workflow))
 
 
 def main_dot(argv: Optional[List[str]] = None):
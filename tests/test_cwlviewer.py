@@ -0,0 +1,177 @@
+import io
+import os
+import shutil
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+from pycwlviewer import cwlviewer
+from pycwlviewer.cwlviewer import CWLViewer, _frag
+
+WORKFLOWS = Path(__file__).parent / 'workflows'
+
+
+def _labels(viewer: CWLViewer):
+    return {node.attr['label'] for node in viewer._dot_graph.nodes()}
+
+
+@pytest.mark.parametrize('use_rdflib', [False, True])
+def test_labels_are_escaped(use_rdflib):
+    viewer = CWLViewer(WORKFLOWS / 'labels.cwl', use_rdflib=use_rdflib)
+    labels = _labels(viewer)
+    # the trailing backslash can only be written doubled, which graphviz renders as one
+    assert 'say "hi" \\\\' in labels
+    assert '<b>x</b>' in labels
+    assert viewer.draw_bytes()
+
+
+def _structure(viewer: CWLViewer):
+    graph = viewer._dot_graph
+    nodes = {str(node): dict(node.attr) for node in graph.nodes()}
+    edges = Counter((str(source), str(target)) for source, target in graph.edges())
+    clusters = {subgraph.name: sorted(subgraph.nodes()) for subgraph in graph.subgraphs()}
+    return viewer.get_root_graph_uri(), nodes, edges, clusters
+
+
+@pytest.mark.parametrize('workflow', [
+    'simple.cwl', 'multiple_sources.cwl', 'duplicate_sources.cwl', 'nested.cwl', 'packed.cwl', 'labels.cwl',
+])
+def test_document_walker_matches_sparql(workflow):
+    assert _structure(CWLViewer(WORKFLOWS / workflow)) == \
+        _structure(CWLViewer(WORKFLOWS / workflow, use_rdflib=True))
+
+
+def test_repeated_sources_are_one_edge():
+    _, _, edges, _ = _structure(CWLViewer(WORKFLOWS / 'duplicate_sources.cwl'))
+    assert sorted((_frag(source), _frag(target), count) for (source, target), count in edges.items()) == [
+        ('a', 's1', 1), ('s1', 'r', 1), ('s1', 's2', 2),
+    ]
+
+
+@pytest.mark.parametrize('use_rdflib', [False, True])
+def test_workflow_without_steps_has_no_root(use_rdflib):
+    with pytest.raises(ValueError, match='no cwl:Workflow root found'):
+        CWLViewer(WORKFLOWS / 'no_steps.cwl', use_rdflib=use_rdflib)
+
+
+def test_draw_format_from_uppercase_suffix(tmp_path):
+    output = tmp_path / 'workflow.PNG'
+    CWLViewer(WORKFLOWS / 'simple.cwl').draw(output)
+    assert output.read_bytes().startswith(b'\x89PNG')
+
+
+def test_draw_to_str_path(tmp_path):
+    output = tmp_path / 'workflow.svg'
+    CWLViewer(WORKFLOWS / 'simple.cwl').draw(str(output))
+    assert b'<svg' in output.read_bytes()
+
+
+def test_draw_to_file_object():
+    output = io.BytesIO()
+    CWLViewer(WORKFLOWS / 'simple.cwl').draw(output)
+    assert output.getvalue().startswith(b'\x89PNG')
+
+
+@pytest.fixture
+def built_viewers(monkeypatch):
+    """Record every CWLViewer the module level helpers build."""
+    built = []
+
+    class RecordingViewer(CWLViewer):
+        def __init__(self, filename, *args, **kwargs):
+            built.append(filename)
+            super().__init__(filename, *args, **kwargs)
+
+    monkeypatch.setattr(cwlviewer, 'CWLViewer', RecordingViewer)
+    cwlviewer._cached_workflow_dot.cache_clear()
+    yield built
+    cwlviewer._cached_workflow_dot.cache_clear()
+
+
+def test_dot_and_view_reuse_the_cached_graph(built_viewers, tmp_path, capsys):
+    cwlviewer.dot(WORKFLOWS / 'simple.cwl')
+    cwlviewer.view(WORKFLOWS / 'simple.cwl', tmp_path / 'workflow.png')
+    cwlviewer.dot(WORKFLOWS / 'simple.cwl')
+    assert len(built_viewers) == 1
+    assert (tmp_path / 'workflow.png').read_bytes().startswith(b'\x89PNG')
+
+
+def test_dot_cache_is_keyed_by_mtime(built_viewers, tmp_path, capsys):
+    workflows = tmp_path / 'workflows'
+    shutil.copytree(str(WORKFLOWS), str(workflows))
+    cwlviewer.dot(workflows / 'simple.cwl')
+    stat = (workflows / 'simple.cwl').stat()
+    os.utime(str(workflows / 'simple.cwl'), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    cwlviewer.dot(workflows / 'simple.cwl')
+    assert len(built_viewers) == 2
+
+
+def test_dot_cache_can_be_disabled(built_viewers, monkeypatch, capsys):
+    monkeypatch.setenv('PYCWLVIEWER_CACHE', '0')
+    cwlviewer.dot(WORKFLOWS / 'simple.cwl')
+    cwlviewer.dot(WORKFLOWS / 'simple.cwl')
+    assert len(built_viewers) == 2
+
+
+def test_tool_document_has_no_root():
+    with pytest.raises(ValueError, match='no cwl:Workflow root found in .*echo.cwl'):
+        CWLViewer(WORKFLOWS / 'echo.cwl', use_rdflib=True)
+
+
+@pytest.mark.parametrize('use_rdflib', [False, True])
+def test_dot_is_stable(use_rdflib):
+    assert len({CWLViewer(WORKFLOWS / 'simple.cwl', use_rdflib=use_rdflib).dot() for _ in range(8)}) == 1
+
+
+@pytest.fixture
+def cwltool_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('PYCWLVIEWER_CWLTOOL_CACHE', '1')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    shutil.copytree(str(WORKFLOWS), str(tmp_path / 'workflows'))
+    return tmp_path
+
+
+@pytest.mark.parametrize('use_rdflib', [False, True])
+def test_cwltool_cache_is_reused(cwltool_cache, monkeypatch, use_rdflib):
+    workflow = cwltool_cache / 'workflows' / 'nested.cwl'
+    expected = CWLViewer(workflow, use_rdflib=use_rdflib).dot()
+    cache_dir = cwltool_cache / 'cache' / 'pycwlviewer'
+    assert cache_dir.stat().st_mode & 0o777 == 0o700
+    assert len(list(cache_dir.iterdir())) == 1
+
+    def load_tool(self):
+        raise AssertionError('cwltool should not be called on a cache hit')
+
+    monkeypatch.setattr(CWLViewer, '_load_tool', load_tool)
+    assert CWLViewer(workflow, use_rdflib=use_rdflib).dot() == expected
+
+
+@pytest.mark.parametrize('use_rdflib', [False, True])
+def test_cwltool_cache_notices_changed_step_files(cwltool_cache, use_rdflib):
+    workflow = cwltool_cache / 'workflows' / 'nested.cwl'
+    assert 'Echo tool' in CWLViewer(workflow, use_rdflib=use_rdflib).dot()
+    echo = cwltool_cache / 'workflows' / 'echo.cwl'
+    echo.write_text(echo.read_text().replace('Echo tool', 'Shout tool'))
+    os.utime(str(echo), ns=(echo.stat().st_atime_ns, echo.stat().st_mtime_ns + 10 ** 9))
+    assert 'Shout tool' in CWLViewer(workflow, use_rdflib=use_rdflib).dot()
+    assert len(list((cwltool_cache / 'cache' / 'pycwlviewer').iterdir())) == 1
+
+
+@pytest.mark.parametrize('content', [
+    '', '{"root": ', '{"nodes": {}, "edges": []}', '#{"format": ["0.0.0", 1], "files": {}}\n{}',
+])
+def test_cwltool_cache_ignores_unusable_files(cwltool_cache, content):
+    workflow = cwltool_cache / 'workflows' / 'simple.cwl'
+    expected = CWLViewer(workflow).dot()
+    cache_file, = (cwltool_cache / 'cache' / 'pycwlviewer').iterdir()
+    cache_file.write_text(content)
+    assert CWLViewer(workflow).dot() == expected
+    assert cache_file.read_text() != content
+
+
+def test_cwltool_cache_write_failure_is_not_fatal(cwltool_cache, caplog):
+    (cwltool_cache / 'cache').mkdir()
+    (cwltool_cache / 'cache' / 'pycwlviewer').write_text('')
+    CWLViewer(cwltool_cache / 'workflows' / 'simple.cwl').dot()
+    assert 'could not write the cache' in caplog.text